@@ -0,0 +1,292 @@
+import collections, hashlib, heapq, os, socket, struct, threading, time, zlib
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from Node import Server, SEGMENT_SIZE, MANIFEST_PAGE_SIZE, manifest_root
+
+class RpcTimeout(Exception):
+	pass
+
+class RttEstimator(object):
+	def __init__(self, initial_rto=1.0, min_rto=0.2, max_rto=10.0):
+		'''
+		Smoothed round trip time estimate for a single peer
+		see: https://tools.ietf.org/html/rfc6298
+		'''
+		self.srtt = None
+		self.rttvar = None
+		self.rto = initial_rto
+		self.min_rto = min_rto
+		self.max_rto = max_rto
+
+	def sample(self, rtt):
+		'''
+		updates estimate with a newly measured round trip time
+		'''
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt/2
+		else:
+			self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+			self.srtt = 0.875*self.srtt + 0.125*rtt
+		self.rto = min(max(self.srtt + 4*self.rttvar, self.min_rto), self.max_rto)
+
+	def timeout(self, attempt=0):
+		'''
+		returns how long to wait for a reply, doubling for each retry
+		'''
+		return min(self.rto*(2**attempt), self.max_rto)
+
+class PendingRequest(object):
+	def __init__(self, data, addr):
+		self.data = data
+		self.addr = addr
+		self.future = Future()
+		self.attempts = 0
+		self.sent_at = None
+
+class Client(object):
+	def __init__(self, node_id=None, port=0, retries=3, initial_rto=1.0, sock=None,
+			max_value_size=1 << 24, max_peers=10000):
+		'''
+		Sends requests to other nodes over a single UDP socket. Replies are
+		matched to outstanding requests by transaction id, so any number of
+		requests to any number of peers can be in flight at once.
+		If sock is given, requests are sent from it and its owner must pass
+		replies to handle_reply.
+		Values larger than max_value_size bytes are refused. Round trip times
+		are remembered for the max_peers most recently contacted peers.
+		'''
+		self.max_value_size = max_value_size
+		self.node_id = node_id if node_id else os.urandom(32)
+		self.retries = retries
+		self.initial_rto = initial_rto
+		self.pending = {} #transaction id -> PendingRequest
+		self.deadlines = [] #heap of (deadline, transaction id, attempt)
+		self.rtts = collections.OrderedDict() #addr -> RttEstimator, in LRU order
+		self.max_peers = max_peers
+		self.lock = threading.Condition()
+		self.closed = False
+		self.owns_sock = sock is None
+		if self.owns_sock:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			sock.bind(('', port))
+		self.udp_sock = sock
+		self.retransmitter = threading.Thread(target=self._retransmit_loop, daemon=True)
+		self.retransmitter.start()
+		if self.owns_sock:
+			self.receiver = threading.Thread(target=self._receive_loop, daemon=True)
+			self.receiver.start()
+
+	def rtt(self, addr):
+		'''
+		returns round trip time estimate for addr, forgetting the least
+		recently used peer once max_peers are known. Caller must hold lock
+		'''
+		if addr in self.rtts:
+			self.rtts.move_to_end(addr)
+			return self.rtts[addr]
+		self.rtts[addr] = RttEstimator(self.initial_rto)
+		if len(self.rtts) > self.max_peers:
+			self.rtts.popitem(last=False)
+		return self.rtts[addr]
+
+	def request(self, code, addr, message=b''):
+		'''
+		Sends request to addr. Returns a Future whose result is the reply as a
+		(message type, sender id, payload) tuple. The future fails with
+		RpcTimeout if no reply arrives after all retries.
+		'''
+		addr = (socket.gethostbyname(addr[0]), addr[1])
+		with self.lock:
+			transaction_id = os.urandom(16)
+			while transaction_id in self.pending:
+				transaction_id = os.urandom(16)
+			data = b''.join([code, self.node_id, transaction_id, message])
+			req = PendingRequest(data, addr)
+			self.pending[transaction_id] = req
+			self._send(transaction_id, req)
+		return req.future
+
+	def _send(self, transaction_id, req):
+		'''
+		(re)sends request and schedules its retransmission. Caller must hold
+		lock. If sending fails, the request is dropped and the error raised
+		'''
+		req.sent_at = time.time()
+		try:
+			self.udp_sock.sendto(req.data, req.addr)
+		except OSError:
+			del self.pending[transaction_id]
+			raise
+		deadline = req.sent_at + self.rtt(req.addr).timeout(req.attempts)
+		heapq.heappush(self.deadlines, (deadline, transaction_id, req.attempts))
+		self.lock.notify()
+
+	def handle_reply(self, data, addr):
+		'''
+		Resolves the pending request a reply datagram belongs to. Replies with
+		an unknown transaction id (ie: late duplicates) are dropped.
+		'''
+		if len(data) < 1 + 32 + 16:
+			return
+		transaction_id = data[33:49]
+		with self.lock:
+			req = self.pending.pop(transaction_id, None)
+			if req is None:
+				return
+			#Karn's algorithm: only sample round trip time if the request was
+			#not retransmitted, otherwise the reply is ambiguous
+			if req.attempts == 0:
+				self.rtt(req.addr).sample(time.time() - req.sent_at)
+		if not req.future.cancelled():
+			req.future.set_result((data[0:1], data[1:33], data[49:]))
+
+	def _receive_loop(self):
+		while not self.closed:
+			try:
+				data, addr = self.udp_sock.recvfrom(65535)
+			except OSError:
+				return
+			self.handle_reply(data, addr)
+
+	def _retransmit_loop(self):
+		with self.lock:
+			while not self.closed:
+				if not self.deadlines:
+					self.lock.wait()
+					continue
+				deadline, transaction_id, attempt = self.deadlines[0]
+				now = time.time()
+				if deadline > now:
+					self.lock.wait(deadline - now)
+					continue
+				heapq.heappop(self.deadlines)
+				req = self.pending.get(transaction_id)
+				if req is None or req.attempts != attempt:
+					#already answered or rescheduled
+					continue
+				if req.attempts < self.retries:
+					req.attempts += 1
+					try:
+						self._send(transaction_id, req)
+					except OSError as e:
+						if not req.future.cancelled():
+							req.future.set_exception(e)
+				else:
+					del self.pending[transaction_id]
+					if not req.future.cancelled():
+						req.future.set_exception(RpcTimeout('no reply from %s:%d' % req.addr))
+
+	def ping(self, addr):
+		return self.request(Server.PING, addr)
+
+	def find_node(self, addr, key):
+		return self.request(Server.FIND_NODE, addr, key)
+
+	def find_value(self, addr, key, accept_compressed=True):
+		flags = Server.ACCEPT_COMPRESSED if accept_compressed else 0
+		return self.request(Server.FIND_VALUE, addr, key + bytes([flags]))
+
+	def store(self, addr, key, value):
+		return self.request(Server.STORE, addr, key + value)
+
+	def fetch_parts(self, addrs, code, reply_code, key, count, valid, window, flags=0):
+		'''
+		Fetches parts 0..count-1 of a large value. Requests are spread across
+		the replicas in addrs with at most `window` in flight. A part whose
+		request times out or whose reply fails valid(index, data) is retried
+		on the next replica. Raises RpcTimeout if every replica failed a part.
+		'''
+		parts = [None]*count
+		tried = [0]*count
+		todo = list(range(count - 1, -1, -1))
+		inflight = {}
+		while todo or inflight:
+			while todo and len(inflight) < window:
+				i = todo.pop()
+				addr = addrs[(i + tried[i]) % len(addrs)]
+				tried[i] += 1
+				message = key + struct.pack('!I', i) + bytes([flags])
+				inflight[self.request(code, addr, message)] = i
+			done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+			for f in done:
+				i = inflight.pop(f)
+				if f.exception() is None:
+					reply_type, _, payload = f.result()
+					if reply_type == reply_code and payload[:4] == struct.pack('!I', i) \
+							and valid(i, payload[4:]):
+						parts[i] = payload[4:]
+						continue
+				if tried[i] >= len(addrs):
+					raise RpcTimeout('could not fetch part %d from any replica' % i)
+				todo.append(i)
+		return parts
+
+	def fetch_large_value(self, addrs, key, info, window=16):
+		'''
+		Fetches a value too large for one datagram from the replicas in addrs
+		given the payload of a LARGE_VALUE_FOUND reply (4B length || manifest
+		root || 1B flags). Raises ValueError if the manifest does not match its
+		root.
+		'''
+		if len(info) != 4 + 32 + 1:
+			raise ValueError('invalid large value info')
+		length = struct.unpack('!I', info[:4])[0]
+		if length > self.max_value_size:
+			raise ValueError('value is too large')
+		root = info[4:36]
+		flags = info[36] & Server.ACCEPT_COMPRESSED
+		count = (length + SEGMENT_SIZE - 1)//SEGMENT_SIZE
+		pages = (count + MANIFEST_PAGE_SIZE - 1)//MANIFEST_PAGE_SIZE
+		def valid_page(i, data):
+			return len(data) == 32*min(MANIFEST_PAGE_SIZE, count - i*MANIFEST_PAGE_SIZE)
+		manifest = b''.join(self.fetch_parts(addrs, Server.FETCH_MANIFEST,
+			Server.MANIFEST_PAGE, key, pages, valid_page, window, flags))
+		if manifest_root([manifest[i:i + 32] for i in range(0, len(manifest), 32)]) != root:
+			raise ValueError('manifest does not match root')
+		def valid_segment(i, data):
+			return hashlib.sha256(data).digest() == manifest[32*i:32*(i + 1)]
+		value = b''.join(self.fetch_parts(addrs, Server.FETCH_SEGMENT,
+			Server.SEGMENT, key, count, valid_segment, window, flags))
+		if len(value) != length:
+			raise ValueError('value has wrong length')
+		if flags:
+			return self.decompress(value)
+		return value
+
+	def decompress(self, data):
+		'''
+		decompresses value from a peer, refusing to inflate it past
+		max_value_size so a small malicious reply can't exhaust memory
+		'''
+		d = zlib.decompressobj()
+		try:
+			value = d.decompress(data, self.max_value_size)
+		except zlib.error:
+			raise ValueError('invalid compressed value')
+		if d.unconsumed_tail or not d.eof:
+			raise ValueError('compressed value is truncated or too large')
+		return value
+
+	def get_value(self, addrs, key):
+		'''
+		Looks up key on addrs[0], fetching large values from all replicas in
+		addrs. Returns None if the value was not found.
+		'''
+		code, _, payload = self.find_value(addrs[0], key).result()
+		if code == Server.SMALL_VALUE_FOUND:
+			return payload
+		elif code == Server.COMPRESSED_VALUE_FOUND:
+			return self.decompress(payload)
+		elif code == Server.LARGE_VALUE_FOUND:
+			return self.fetch_large_value(addrs, key, payload)
+		return None
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			self.lock.notify()
+			for req in self.pending.values():
+				req.future.cancel()
+			self.pending = {}
+		if self.owns_sock:
+			self.udp_sock.close()
@@ -1,12 +1,14 @@
-import time
+import time, zlib
 
 class Value:
-	def __init__(self, value, expiration=-1):
+	def __init__(self, value, expiration=-1, compressed=False):
 		'''
 		For values that never expire, set expiration to -1
+		If compressed is set, value holds the zlib compressed bytes
 		'''
 		self.value = value
 		self.expiration = expiration
+		self.compressed = compressed
 
 	def expired(self):
 		''' 
@@ -17,12 +19,15 @@ class Value:
 		return time.time() > self.expiration
 
 class KeyValueStore:
-	def __init__(self, default_ttl=-1):
+	def __init__(self, default_ttl=-1, compress=False):
 		'''
 		ttl of -1 means item never expires
+		If compress is set, byte string values are kept zlib compressed when
+		that makes them smaller
 		'''
 		self.store = {}
 		self.default_ttl = default_ttl
+		self.compress = compress
 
 	def remove_expired(self):
 		for k in list(self.store.keys()):
@@ -33,7 +38,16 @@ class KeyValueStore:
 		return key in self.store
 
 	def __getitem__(self, key):
-		return self.store[key].value
+		v = self.store[key]
+		if v.compressed:
+			return zlib.decompress(v.value)
+		return v.value
+
+	def get_stored(self, key):
+		'''
+		returns Value as stored, so compressed bytes can be used directly
+		'''
+		return self.store[key]
 
 	def set(self, key, item, ttl):
 		'''
@@ -43,6 +57,11 @@ class KeyValueStore:
 			expiration = -1;
 		else:
 			expiration = ttl + time.time()
+		if self.compress and isinstance(item, bytes):
+			compressed = zlib.compress(item)
+			if len(compressed) < len(item):
+				self.store[key] = Value(compressed, expiration, True)
+				return
 		self.store[key] = Value(item, expiration)
 
 	def __setitem__(self, key, item):
@@ -1,4 +1,16 @@
-import binascii, KeyValueStore, os, socket, struct, sys, time
+import binascii, collections, hashlib, heapq, KeyValueStore, os, Profiling, random, socket, struct, sys, threading, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+try:
+	import numpy
+except ImportError:
+	#batch queries fall back to pure python
+	numpy = None
+
+#values too large for one datagram are split into segments of this size so
+#that a SEGMENT reply (header || 4B index || data) still fits in 512 bytes
+SEGMENT_SIZE = 448
+#number of segment hashes per MANIFEST_PAGE reply
+MANIFEST_PAGE_SIZE = 14
 
 def xor(s1, s2):
 	return bytes(b1 ^ b2 for b1, b2 in zip(s1, s2))
@@ -24,6 +36,21 @@ def bucket_index(distance):
 def bytes_to_hex(bs):
 	return str(binascii.hexlify(bs), 'ascii')
 
+def split_segments(value, size=SEGMENT_SIZE):
+	return [value[i:i + size] for i in range(0, len(value), size)]
+
+def segment_hashes(value, size=SEGMENT_SIZE):
+	'''
+	returns the manifest of a large value: the sha256 hash of each segment
+	'''
+	return [hashlib.sha256(s).digest() for s in split_segments(value, size)]
+
+def manifest_root(hashes):
+	'''
+	returns a single hash committing to the whole manifest
+	'''
+	return hashlib.sha256(b''.join(hashes)).digest()
+
 class Contact(object):
 	def __init__(self, node_id, ip, port):
 		self.node_id = node_id
@@ -55,8 +82,14 @@ class Contact(object):
 		if len(raw) != 32 + 4 + 2:
 			return None
 		node_id = raw[:32]
+		#0.x.x.x is not a host address, 224.x.x.x and up are multicast,
+		#reserved or broadcast
+		if raw[32] == 0 or raw[32] >= 224:
+			return None
 		ip = socket.inet_ntoa(raw[32:36])
 		port = struct.unpack('!H', raw[36:40])[0]
+		if port == 0:
+			return None
 		return Contact(node_id, ip, port)
 
 	def __repr__(self):
@@ -87,6 +120,11 @@ class Bucket(object):
 		self.pending_removal = [] #(contact, expiration)
 		self.pending_addition = []
 		self.max_size = max_size
+		#time bucket was last updated or refreshed
+		self.last_activity = time.time()
+		#incremented whenever contacts or pending_addition gain or lose a
+		#contact so snapshots know to repack bucket. Reordering does not count
+		self.version = 0
 
 	def remove_expired(self):
 		'''
@@ -105,6 +143,7 @@ class Bucket(object):
 				#sorted by time last seen
 				lt = lambda x, y: x.last_seen < y.last_seen
 				insort_right(self.contacts, self.pending_addition[i], lt)
+				self.version += 1
 		self.pending_removal = npr
 		self.pending_addition = npa
 
@@ -118,6 +157,7 @@ class Bucket(object):
 		assert(len(self.pending_addition) == len(self.pending_removal))
 
 		self.remove_expired()
+		self.last_activity = time.time()
 
 		if contact in self.contacts:
 			#if contact exists, move it to end of bucket
@@ -140,14 +180,17 @@ class Bucket(object):
 				self.contacts.append(old)
 				#remove coresponding pending addition
 				self.pending_addition.pop(idx)
+				self.version += 1
 			elif len(self.contacts) + len(self.pending_removal) < self.max_size:
 				#there is space, so previously unseen contact can be added
 				self.contacts.append(contact)
+				self.version += 1
 			elif len(self.contacts) > 0:
 				#already have full set of contacts => must remove some
 				oldest = self.contacts.pop(0)
 				self.pending_removal.append((oldest, time.time() + ttl))
 				self.pending_addition.append(contact)
+				self.version += 1
 				#NOTE: caller's responsibility to check if old node still online
 				return oldest
 				#otherwise, already have move than enought "fresh" contacts
@@ -160,11 +203,93 @@ class Bucket(object):
 		#TODO: have repr show pending removals + additions
 		return 'Bucket([' + ',\n'.join([c.__repr__() for c in self.contacts]) + '])'
 
+def ids_to_limbs(ids):
+	'''
+	packs 32 byte ids into an (n, 4) array of uint64 limbs, most significant
+	first, so comparing rows limb by limb orders them like the ids
+	'''
+	raw = numpy.frombuffer(b''.join(ids), dtype='>u8')
+	return raw.reshape(-1, 4).astype(numpy.uint64)
+
+class RoutingSnapshot(object):
+	def __init__(self, node):
+		'''
+		Array backed copy of a routing table for batch closest node queries.
+		refresh only repacks buckets whose version changed. contacts and ids
+		are published together as one tuple, so a query running during a
+		refresh sees either the old or the new table, never a mix.
+		'''
+		self.node = node
+		self.bucket_cache = {} #bucket index -> (version, contacts, ids)
+		self.versions = None
+		self.table = ([], numpy.zeros((0, 4), numpy.uint64)) #(contacts, ids)
+
+	def refresh(self):
+		versions = [b.version for b in self.node.buckets]
+		if versions == self.versions:
+			return
+		for j, b in enumerate(self.node.buckets):
+			cached = self.bucket_cache.get(j)
+			if cached and cached[0] == b.version:
+				continue
+			contacts = b.contacts + b.pending_addition
+			if contacts:
+				ids = ids_to_limbs([c.node_id for c in contacts])
+				self.bucket_cache[j] = (b.version, contacts, ids)
+			else:
+				self.bucket_cache.pop(j, None)
+		cached = [self.bucket_cache[j] for j in sorted(self.bucket_cache)]
+		contacts = [c for _, contacts, _ in cached for c in contacts]
+		if cached:
+			ids = numpy.concatenate([ids for _, _, ids in cached])
+		else:
+			ids = numpy.zeros((0, 4), numpy.uint64)
+		self.table = (contacts, ids)
+		self.versions = versions
+
+	def closest(self, targets, k=20, max_pairs=1 << 18):
+		'''
+		returns the k closest contacts to each target. targets is a sequence
+		of 32 byte ids or an (n, 4) array from ids_to_limbs. Distances are
+		computed for at most max_pairs (target, contact) pairs at a time
+		'''
+		contacts, ids = self.table
+		if not isinstance(targets, numpy.ndarray):
+			targets = ids_to_limbs(targets) if len(targets) else numpy.zeros((0, 4), numpy.uint64)
+		n = len(contacts)
+		if n == 0:
+			return [[] for _ in range(len(targets))]
+		k = min(k, n)
+		chunk = max(1, max_pairs//n)
+		closest = []
+		for start in range(0, len(targets), chunk):
+			d = targets[start:start + chunk, None, :] ^ ids[None, :, :]
+			if k < n:
+				#select by most significant limb, then sort selection exactly
+				part = numpy.argpartition(d[:, :, 0], k - 1, axis=1)[:, :k]
+			else:
+				part = numpy.broadcast_to(numpy.arange(n), d.shape[:2])
+			sel = numpy.take_along_axis(d, part[:, :, None], axis=1)
+			order = numpy.lexsort((sel[:, :, 3], sel[:, :, 2], sel[:, :, 1], sel[:, :, 0]))
+			best = numpy.take_along_axis(part, order, axis=1)
+			if k < n:
+				#if a contact left out ties with the selection on the most
+				#significant limb, the selection may be wrong => sort whole row
+				kth = sel[:, :, 0].max(axis=1)[:, None]
+				ties = (d[:, :, 0] == kth).sum(axis=1) != (sel[:, :, 0] == kth).sum(axis=1)
+				for r in numpy.nonzero(ties)[0]:
+					best[r] = numpy.lexsort((d[r, :, 3], d[r, :, 2], d[r, :, 1], d[r, :, 0]))[:k]
+			closest.extend([contacts[i] for i in row] for row in best.tolist())
+		return closest
+
 class Node(object):
 	def __init__(self):
 		#node_id is randomly chosen
 		self.node_id = os.urandom(32)
 		self.buckets = [Bucket() for _ in range(256)]
+		#request loop, bootstrap and refresh threads all use routing table
+		self.lock = threading.RLock()
+		self.snapshot = RoutingSnapshot(self) if numpy is not None else None
 
 	def distance(self, node_id):
 		'''
@@ -183,7 +308,30 @@ class Node(object):
 		If lru contact is returned, caller must ping it.
 		'''
 		d = self.distance(contact.node_id)
-		return self.buckets[bucket_index(d)].update(contact, ttl)
+		with self.lock:
+			return self.buckets[bucket_index(d)].update(contact, ttl)
+
+	def random_id_in_bucket(self, j):
+		'''
+		returns a random id whose distance d from this node satisfies
+		2^j <= d < 2^(j + 1), ie: an id that belongs in bucket j
+		'''
+		d = (1 << j) | random.getrandbits(j)
+		return xor(self.node_id, d.to_bytes(32, 'big'))
+
+	def stale_buckets(self, interval):
+		'''
+		returns indices of buckets with no activity in the last interval
+		seconds. Buckets closer than our closest contact are skipped since
+		there are no nodes to find there
+		'''
+		with self.lock:
+			nonempty = [j for j, b in enumerate(self.buckets) if not b.empty()]
+			if not nonempty:
+				return []
+			cutoff = time.time() - interval
+			return [j for j in range(nonempty[0], len(self.buckets))
+				if self.buckets[j].last_activity <= cutoff]
 
 	def closest_nodes(self, node_id, k = 20):
 		'''
@@ -193,26 +341,41 @@ class Node(object):
 		d = self.distance(node_id)
 		idx = bucket_index(d)
 
-		#use known "fresh" contacts over old ones
-		closest.extend(self.buckets[idx].contacts)
-		closest.extend(self.buckets[idx].pending_addition)
-
-		i = 1
-		#add nodes until we have >= k (or there are no more nodes left to add)
-		while len(closest) < k and (idx - i >= 0 or idx + i < len(self.buckets)):
-			if idx - i >= 0:
-				closest.extend(self.buckets[idx - i].contacts)
-				closest.extend(self.buckets[idx - i].pending_addition)
-			if idx + i < len(self.buckets):
-				closest.extend(self.buckets[idx + i].contacts)
-				closest.extend(self.buckets[idx + i].pending_addition)
-			i = i + 1
+		with self.lock:
+			#use known "fresh" contacts over old ones
+			closest.extend(self.buckets[idx].contacts)
+			closest.extend(self.buckets[idx].pending_addition)
+
+			i = 1
+			#add nodes until we have >= k (or there are no more nodes left to add)
+			while len(closest) < k and (idx - i >= 0 or idx + i < len(self.buckets)):
+				if idx - i >= 0:
+					closest.extend(self.buckets[idx - i].contacts)
+					closest.extend(self.buckets[idx - i].pending_addition)
+				if idx + i < len(self.buckets):
+					closest.extend(self.buckets[idx + i].contacts)
+					closest.extend(self.buckets[idx + i].pending_addition)
+				i = i + 1
 		#sort to get k closest
 		#TODO: could be faster (computes xor too often)
 		#TODO: add option to ignore specific node (ie: the requestor's id)
 		closest.sort(key=lambda c: xor(c.node_id, node_id))
 		return closest[:k]
 
+	def closest_nodes_batch(self, targets, k = 20):
+		'''
+		returns list with the k nodes in routing table closest to each target.
+		Unlike closest_nodes, considers every contact, so results are exact.
+		Uses a vectorized RoutingSnapshot if numpy is available
+		'''
+		if self.snapshot is None:
+			with self.lock:
+				contacts = [c for b in self.buckets for c in b.contacts + b.pending_addition]
+			return [heapq.nsmallest(k, contacts, key=lambda c: xor(c.node_id, t)) for t in targets]
+		with self.lock:
+			self.snapshot.refresh()
+		return self.snapshot.closest(targets, k)
+
 	def __repr__(self):
 		hs = bytes_to_hex(self.node_id)
 		bs = ',\n'.join([b.__repr__() for b in self.buckets if not b.empty()])
@@ -238,15 +401,45 @@ class Server(object):
 	#if value not found, return results of find node
 	#if value is small enough for a UPD packet, set it
 	SMALL_VALUE_FOUND = b'\x09'
-	#if value too big for one packet, have client fetch over TCP
+	#if value too big for one packet, reply with its length and manifest root
+	#so client can fetch the manifest and segments over UDP
 	LARGE_VALUE_FOUND = b'\x0a'
-
-	def __init__(self, node, verbose=True):
+	FETCH_MANIFEST = b'\x0b'
+	MANIFEST_PAGE = b'\x0c'
+	FETCH_SEGMENT = b'\x0d'
+	SEGMENT = b'\x0e'
+	#like SMALL_VALUE_FOUND, but value is zlib compressed
+	COMPRESSED_VALUE_FOUND = b'\x0f'
+	#introspection commands, only accepted from localhost
+	ADMIN = b'\x10'
+	ADMIN_REPLY = b'\x11'
+
+	#flags clients may append to FIND_VALUE, FETCH_MANIFEST and FETCH_SEGMENT
+	ACCEPT_COMPRESSED = 0x01
+
+	#ADMIN commands
+	ADMIN_PROFILE = 0x01
+	ADMIN_MEMORY = 0x02
+	ADMIN_TRACE_START = 0x03
+	ADMIN_TRACE_STOP = 0x04
+
+	#replies to requests this node sent, passed on to its client
+	REPLIES = {ERROR, PONG, STORE_SUCCESS, STORE_FAILURE, FIND_NODE_REPLY,
+		SMALL_VALUE_FOUND, LARGE_VALUE_FOUND, MANIFEST_PAGE, SEGMENT,
+		COMPRESSED_VALUE_FOUND}
+
+	def __init__(self, node, verbose=True, compress=True):
 		self.node = node
 		#TODO: make use of expiration
 		#	add timers to periodically remove expired entries
 		#	make store automatically determine expiration data
-		self.store = KeyValueStore.KeyValueStore()
+		self.store = KeyValueStore.KeyValueStore(compress=compress)
+		self.manifests = {} #(key, compressed) -> segment hashes of large value
+		#key -> (stored Value, decompressed bytes) for clients that don't
+		#accept compressed values, so segment fetches don't decompress
+		#the whole value every time
+		self.decompressed = collections.OrderedDict()
+		self.decompressed_cache_size = 16
 		self.client_addr = None
 		self.message_type = None
 		self.client_id = None
@@ -254,6 +447,9 @@ class Server(object):
 		self.packet_data = None
 		self.verbose = verbose
 		self.udp_sock = None
+		self.client = None
+		self.raw_packet = None
+		self.profiler = Profiling.Profiler(self)
 
 	def log(self, message):
 		if self.verbose:
@@ -280,7 +476,6 @@ class Server(object):
 			self.log('client error: header is too short')
 			self.send_error(b'header is too short')
 			return 
-		print(type(self.packet_data))
 		self.message_type = self.packet_data[0:1]
 		self.client_id = self.packet_data[1:33]
 		self.transaction_id = self.packet_data[33:49]
@@ -293,10 +488,18 @@ class Server(object):
 		self.send(Server.PONG)
 
 	def handle_pong(self):
-		print("Got pong %s:%d", self.client_addr)
+		self.log('Got pong from %s:%d' % self.client_addr)
 		#don't have to do anything except update routing table
 		#(which happend automatically)
-		pass
+		self.handle_reply()
+
+	def handle_reply(self):
+		'''
+		replies to our own requests arrive on the server socket so that peers
+		learn our listening address => hand them to the client
+		'''
+		if self.client:
+			self.client.handle_reply(self.raw_packet, self.client_addr)
 
 	def handle_find_node(self):
 		'''
@@ -315,31 +518,145 @@ class Server(object):
 
 	def handle_find_value(self):
 		'''
-		packet format: headers || key
+		packet format: headers || key [|| 1B flags]
 		If value corresponding to key is present, value is returned over udp if
-		small enought. Otherwise a LARGE_VALUE_FOUND code is sent to tell
-		client to fetch over TCP.
+		small enought (compressed if client sets ACCEPT_COMPRESSED). Otherwise a
+		LARGE_VALUE_FOUND reply is sent with the 4B value length || 32B manifest
+		root || 1B flags, and client fetches the manifest and segments with
+		FETCH_MANIFEST and FETCH_SEGMENT. If flags has ACCEPT_COMPRESSED set,
+		the segments are of the compressed value.
 		If key not present, server returns results of a find_node
 		'''
-		if len(self.packet_data) != 32:
+		if len(self.packet_data) not in (32, 33):
 			self.log('client error: key is wrong length')
 			self.send_error(b'key is wrong length')
 			return
-		key = self.packet_data
+		key = self.packet_data[:32]
+		flags = self.packet_data[32] if len(self.packet_data) == 33 else 0
 		if key in self.store:
-			value = self.store[key]
+			value, compressed = self.stored_value(key, flags)
 			if len(value) <= 512:
 				self.log('Find %s -> %s' % (key, value[:32]))
 				#return value over udp if it's small enought
-				self.send(Server.SMALL_VALUE_FOUND, value)
+				if compressed:
+					self.send(Server.COMPRESSED_VALUE_FOUND, value)
+				else:
+					self.send(Server.SMALL_VALUE_FOUND, value)
 			else:
 				self.log('Find %s -> %s [Too large to return]' % (key, value[:32]))
-				#otherwise tell client to use TCP
-				self.send(Server.LARGE_VALUE_FOUND)
+				#otherwise tell client to fetch it in segments
+				root = manifest_root(self.manifest(key, flags))
+				flags = Server.ACCEPT_COMPRESSED if compressed else 0
+				self.send(Server.LARGE_VALUE_FOUND,
+					struct.pack('!I', len(value)) + root + bytes([flags]))
 		else:
 			self.log('Value for %s not found' % key)
+			self.packet_data = key
 			self.handle_find_node()
 
+	def stored_value(self, key, flags):
+		'''
+		returns (value, compressed). Stored compressed bytes are sent as is
+		to clients that accept them and decompressed for those that don't
+		'''
+		v = self.store.get_stored(key)
+		if not v.compressed:
+			return v.value, False
+		if flags & Server.ACCEPT_COMPRESSED:
+			return v.value, True
+		cached = self.decompressed.get(key)
+		if cached and cached[0] is v:
+			self.decompressed.move_to_end(key)
+			return cached[1], False
+		value = self.store[key]
+		self.decompressed[key] = (v, value)
+		if len(self.decompressed) > self.decompressed_cache_size:
+			self.decompressed.popitem(last=False)
+		return value, False
+
+	def manifest(self, key, flags):
+		'''
+		returns segment hashes of value stored under key, computing them once
+		'''
+		compressed = bool(flags & Server.ACCEPT_COMPRESSED) and self.store.get_stored(key).compressed
+		if (key, compressed) not in self.manifests:
+			self.manifests[(key, compressed)] = segment_hashes(self.stored_value(key, flags)[0])
+		return self.manifests[(key, compressed)]
+
+	def parse_part_request(self):
+		'''
+		packet format: headers || key || 4B index [|| 1B flags]
+		returns (key, index, flags) or None if request is invalid
+		'''
+		if len(self.packet_data) not in (32 + 4, 32 + 4 + 1):
+			self.log('client error: request is wrong length')
+			self.send_error(b'request is wrong length')
+			return None
+		key = self.packet_data[:32]
+		if key not in self.store:
+			self.log('Value for %s not found' % key)
+			self.send_error(b'value not found')
+			return None
+		flags = self.packet_data[36] if len(self.packet_data) == 37 else 0
+		return key, struct.unpack('!I', self.packet_data[32:36])[0], flags
+
+	def handle_fetch_manifest(self):
+		'''
+		packet format: headers || key || 4B page number [|| 1B flags]
+		Server returns 4B page number || up to MANIFEST_PAGE_SIZE segment hashes
+		'''
+		req = self.parse_part_request()
+		if not req: return
+		key, page, flags = req
+		hashes = self.manifest(key, flags)[page*MANIFEST_PAGE_SIZE:(page + 1)*MANIFEST_PAGE_SIZE]
+		if not hashes:
+			self.send_error(b'page out of range')
+			return
+		self.send(Server.MANIFEST_PAGE, struct.pack('!I', page) + b''.join(hashes))
+
+	def handle_fetch_segment(self):
+		'''
+		packet format: headers || key || 4B segment index [|| 1B flags]
+		Server returns 4B segment index || segment
+		'''
+		req = self.parse_part_request()
+		if not req: return
+		key, idx, flags = req
+		value = self.stored_value(key, flags)[0]
+		if idx*SEGMENT_SIZE >= len(value):
+			self.send_error(b'segment out of range')
+			return
+		segment = value[idx*SEGMENT_SIZE:(idx + 1)*SEGMENT_SIZE]
+		self.send(Server.SEGMENT, struct.pack('!I', idx) + segment)
+
+	def handle_admin(self):
+		'''
+		packet format: headers || 1B command || args
+		ADMIN_PROFILE args: [4B seconds] profiles request loop
+		ADMIN_MEMORY args: none, writes memory report
+		ADMIN_TRACE_START, ADMIN_TRACE_STOP args: none, start/stop tracemalloc
+		Server replies with the path output will be written to (or nothing
+		for tracing commands)
+		'''
+		if not self.client_addr[0].startswith('127.'):
+			self.log('client error: admin message from %s' % self.client_addr[0])
+			self.send_error(b'admin messages only allowed from localhost')
+			return
+		command = self.packet_data[:1]
+		if command == bytes([Server.ADMIN_PROFILE]) and len(self.packet_data) in (1, 5):
+			seconds = struct.unpack('!I', self.packet_data[1:])[0] if len(self.packet_data) == 5 else None
+			self.send(Server.ADMIN_REPLY, self.profiler.request_profile(seconds).encode())
+		elif command == bytes([Server.ADMIN_MEMORY]) and len(self.packet_data) == 1:
+			self.send(Server.ADMIN_REPLY, self.profiler.memory_snapshot().encode())
+		elif command == bytes([Server.ADMIN_TRACE_START]) and len(self.packet_data) == 1:
+			self.profiler.start_tracing()
+			self.send(Server.ADMIN_REPLY)
+		elif command == bytes([Server.ADMIN_TRACE_STOP]) and len(self.packet_data) == 1:
+			self.profiler.stop_tracing()
+			self.send(Server.ADMIN_REPLY)
+		else:
+			self.send_error(b'invalid admin command')
+
 	def handle_store(self):
 		'''
 		packet format: headers || key || value
@@ -353,21 +670,161 @@ class Server(object):
 		value = self.packet_data[32:]
 		self.log('Storing %s -> %s' % (key, value[:32]))
 		self.store[key] = value
+		self.manifests.pop((key, False), None)
+		self.manifests.pop((key, True), None)
+		self.decompressed.pop(key, None)
 		self.send(Server.STORE_SUCCESS)
 
-	def handle_udp(self, port):
-		self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	def lookup(self, target, k=20, alpha=3):
+		'''
+		Iterative node lookup. Sends FIND_NODE for target to the alpha closest
+		contacts not yet queried in parallel until the k closest contacts
+		known have all been queried. Returns the k closest contacts found.
+		'''
+		shortlist = {c.node_id: c for c in self.node.closest_nodes(target, k)}
+		queried = set()
+		inflight = {}
+		while True:
+			closest = sorted(shortlist.values(), key=lambda c: xor(c.node_id, target))[:k]
+			todo = [c for c in closest if c.node_id not in queried]
+			if not todo and not inflight:
+				return closest
+			while todo and len(inflight) < alpha:
+				c = todo.pop(0)
+				queried.add(c.node_id)
+				try:
+					inflight[self.client.find_node((c.ip, c.port), target)] = c
+				except OSError as e:
+					#unreachable address => treat like unresponsive node
+					self.log('Could not query %s:%d: %s' % (c.ip, c.port, e))
+					del shortlist[c.node_id]
+			if not inflight:
+				continue
+			done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+			for f in done:
+				c = inflight.pop(f)
+				if f.exception() is not None:
+					#unresponsive nodes should not be returned
+					del shortlist[c.node_id]
+					continue
+				code, _, payload = f.result()
+				if code != Server.FIND_NODE_REPLY:
+					continue
+				for i in range(0, len(payload), 38):
+					found = Contact.decode(payload[i:i + 38])
+					if found and found.node_id != self.node.node_id:
+						shortlist.setdefault(found.node_id, found)
+
+	def refresh_bucket(self, j):
+		'''
+		looks up a random id in bucket j's range to fill it with fresh contacts
+		'''
+		self.log('Refreshing bucket %d' % j)
+		with self.node.lock:
+			self.node.buckets[j].last_activity = time.time()
+		self.lookup(self.node.random_id_in_bucket(j))
+
+	def bootstrap(self, seeds, parallel=8):
+		'''
+		Joins the network through the given seed addresses. Seeds are pinged
+		in parallel, then a lookup of our own id finds our neighbors and the
+		buckets further out are refreshed, up to `parallel` at a time.
+		Returns False if no seed replied. Seeds that reply are added to the
+		routing table by the request loop.
+		'''
+		futures = []
+		for addr in seeds:
+			try:
+				futures.append(self.client.ping(addr))
+			except OSError as e:
+				self.log('Could not ping seed %s:%d: %s' % (addr[0], addr[1], e))
+		wait(futures)
+		if not any(f.exception() is None for f in futures):
+			self.log('No seed node replied')
+			return False
+		self.lookup(self.node.node_id)
+		with ThreadPoolExecutor(parallel) as pool:
+			refreshes = {pool.submit(self.refresh_bucket, j): j for j in self.node.stale_buckets(0)}
+		for f, j in refreshes.items():
+			if f.exception() is not None:
+				#one failed refresh must not abort bootstrap
+				self.log('Could not refresh bucket %d: %r' % (j, f.exception()))
+		return True
+
+	def refresh_loop(self, interval=3600, spacing=None):
+		'''
+		Refreshes buckets with no activity in the last interval seconds. At
+		most one bucket is refreshed every spacing seconds (by default
+		interval/256, enough to refresh every bucket once per interval), so
+		refreshes are spread out over time instead of happening in bursts.
+		'''
+		if spacing is None:
+			spacing = interval/len(self.node.buckets)
+		while True:
+			try:
+				stale = self.node.stale_buckets(interval)
+				if stale:
+					self.refresh_bucket(random.choice(stale))
+			except Exception as e:
+				#one failed refresh must not stop the scheduler
+				self.log('Bucket refresh failed: %r' % e)
+			time.sleep(spacing)
+
+	def start_refresh(self, interval=3600, spacing=None):
+		t = threading.Thread(target=self.refresh_loop, args=(interval, spacing), daemon=True)
+		t.start()
+		return t
+
+	def update_route(self):
+		'''
+		adds sender of current packet to routing table. If its bucket is full,
+		the least recently seen contact is pinged to check it is still alive
+		'''
+		lru = self.node.update_route(Contact(self.client_id, *self.client_addr))
+		if lru:
+			#must contact old node to warn of impending removal
+			self.log('Pinging %s:%d to check liveness...' % (lru.ip, lru.port))
+			try:
+				self.client.ping((lru.ip, lru.port))
+			except OSError as e:
+				self.log('Could not ping %s:%d: %s' % (lru.ip, lru.port, e))
+
+	def bind(self, port):
+		'''
+		creates server socket and a client that sends requests from it
+		'''
+		import Client
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		#TODO: add error handling
-		self.udp_sock.bind(('', port))
+		sock.bind(('', port))
+		self.client = Client.Client(self.node.node_id, sock=sock)
+		self.udp_sock = sock
 		self.log('Listening on port %d' % port)
+
+	def handle_udp(self, port=None):
+		if self.udp_sock is None:
+			self.bind(port)
+		self.profiler.loop_thread = threading.get_ident()
 		while True:
-			self.packet_data, self.client_addr = self.udp_sock.recvfrom(512)
+			if not self.profiler.wait(self.udp_sock):
+				continue
+			#replies to our lookups can be larger than 512 bytes
+			self.raw_packet, self.client_addr = self.udp_sock.recvfrom(65535)
+			self.packet_data = self.raw_packet
 			self.log('Packet from %s:%d %s' % (self.client_addr[0], self.client_addr[1], self.packet_data[:32]))
 			self.parse_header()
 			if not self.message_type: continue
+			self.profiler.poll()
+			if self.message_type == Server.ADMIN:
+				#admin tools are not nodes => don't add them to routing table
+				self.handle_admin()
+				continue
+			start = time.time()
+			if self.message_type in Server.REPLIES:
+				#record sender before waking up whoever waits for the reply
+				self.update_route()
 
 			#TODO: could use dispatcher ie: {Server.PING: self.handle_ping, ....}
-			print(self.message_type, Server.PING)
 			if self.message_type == Server.PING:
 				self.handle_ping()
 			elif self.message_type == Server.PONG:
@@ -378,25 +835,44 @@ class Server(object):
 				self.handle_find_value()
 			elif self.message_type == Server.STORE:
 				self.handle_store()
+			elif self.message_type == Server.FETCH_MANIFEST:
+				self.handle_fetch_manifest()
+			elif self.message_type == Server.FETCH_SEGMENT:
+				self.handle_fetch_segment()
+			elif self.message_type in Server.REPLIES:
+				self.handle_reply()
 			else:
 				self.send_error(b'unknown message type')
 				continue
-			lru = self.node.update_route(Contact(self.client_id, *self.client_addr))
-			if lru:
-				#must contact old node to warn of impending removal
-				#TODO: move this out of main loop
-				self.client_addr = (lru.ip, lru.port)
-				self.log('Pinging %s:%d to check liveness...' % self.client_addr)
-				self.transaction_id = os.urandom(16)
-				self.send(Server.PING)
+			if self.message_type not in Server.REPLIES:
+				self.update_route()
+			self.profiler.request_finished(self.message_type, time.time() - start, self.client_addr)
 			self.log(self.node.__repr__())
 
+def parse_addr(s):
+	'''
+	parses address of form ip:port, returns (ip, port) or None if invalid
+	'''
+	ip, _, port = s.rpartition(':')
+	if not ip or not port_str_valid(port):
+		return None
+	return ip, int(port)
+
 def usage(name):
-	print('usage: %s <port>' % (name, ))
+	print('usage: %s <port> [<seed ip>:<seed port> ...]' % (name, ))
 	sys.exit(1)
 
 if __name__ == '__main__':
-	if len(sys.argv) != 2 or not port_str_valid(sys.argv[1]):
+	if len(sys.argv) < 2 or not port_str_valid(sys.argv[1]):
+		usage(sys.argv[0])
+	seeds = [parse_addr(a) for a in sys.argv[2:]]
+	if None in seeds:
 		usage(sys.argv[0])
 	s = Server(Node())
-	s.handle_udp(int(sys.argv[1]))
+	s.bind(int(sys.argv[1]))
+	if seeds:
+		threading.Thread(target=s.bootstrap, args=(seeds,), daemon=True).start()
+	s.start_refresh()
+	#SIGUSR1 profiles request loop, SIGUSR2 writes memory report
+	s.profiler.install_signals()
+	s.handle_udp()
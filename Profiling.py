@@ -0,0 +1,221 @@
+import collections, cProfile, select, signal, socket, sys, threading, time, tracemalloc
+
+class Profiler(object):
+	def __init__(self, server, profile_seconds=30, profile_path='node.prof',
+			snapshot_path='node.mem', slow_threshold=0.1, slow_thresholds=None):
+		'''
+		Runtime introspection for a live Server. Everything can be turned on
+		without a restart with a signal (see install_signals) or an ADMIN
+		message.
+		slow_thresholds maps message type -> seconds after which a request of
+		that type is logged as slow. Other types use slow_threshold.
+		'''
+		self.server = server
+		self.profile_seconds = profile_seconds
+		self.profile_path = profile_path
+		self.snapshot_path = snapshot_path
+		self.slow_threshold = slow_threshold
+		self.slow_thresholds = slow_thresholds if slow_thresholds else {}
+		self.slow_requests = collections.deque(maxlen=1000) #(time, type, seconds, addr)
+		self.profile = None
+		self.profile_request = None #(seconds, path)
+		self.profile_end = None
+		self.profile_out = None
+		#thread running request loop, set by Server.handle_udp
+		self.loop_thread = None
+		#signals wake up request loop by writing to wakeup_writer, see install_signals
+		self.wakeup = None
+		self.wakeup_writer = None
+
+	def request_profile(self, seconds=None, path=None):
+		'''
+		Asks the request loop to run under cProfile for the given number of
+		seconds, then write stats to path. Returns path. cProfile only
+		profiles the thread it was enabled in, so profiling starts right away
+		when called from the request loop thread (including signal handlers
+		when the loop runs in the main thread). Otherwise the request loop
+		starts it on the next request, or right away if it is woken up by a
+		signal. The request loop stops it on time, even without traffic.
+		'''
+		seconds = seconds if seconds else self.profile_seconds
+		path = path if path else self.profile_path
+		self.profile_request = (seconds, path)
+		if threading.get_ident() == self.loop_thread:
+			self.poll()
+		return path
+
+	def timeout(self):
+		'''
+		returns how long the request loop may wait for a packet before it
+		must call poll, or None to wait forever
+		'''
+		if self.profile:
+			return max(0, self.profile_end - time.time())
+		if self.profile_request:
+			return 0
+		return None
+
+	def wait(self, sock):
+		'''
+		called by the request loop before reading a packet from sock. Returns
+		True once sock is readable, or False if the loop was woken up to let
+		the profiler act. Blocks on sock alone if there is nothing to wait for
+		'''
+		timeout = self.timeout()
+		if timeout is None and self.wakeup is None:
+			return True
+		fds = [sock] if self.wakeup is None else [sock, self.wakeup]
+		readable = select.select(fds, [], [], timeout)[0]
+		if self.wakeup in readable:
+			try:
+				while self.wakeup.recv(512):
+					pass
+			except BlockingIOError:
+				pass
+		self.poll()
+		return sock in readable
+
+	def poll(self):
+		'''
+		called by the request loop before handling each request and when
+		waiting for one times out. Starts and stops cProfile
+		'''
+		if self.profile and time.time() >= self.profile_end:
+			self.profile.disable()
+			self.profile.dump_stats(self.profile_out)
+			self.server.log('Wrote profile to %s' % self.profile_out)
+			self.profile = None
+		if self.profile_request and not self.profile:
+			seconds, self.profile_out = self.profile_request
+			self.profile_request = None
+			self.profile_end = time.time() + seconds
+			self.profile = cProfile.Profile()
+			self.profile.enable()
+
+	def request_finished(self, message_type, seconds, addr):
+		'''
+		logs request if handling it took longer than the threshold for its type
+		'''
+		if seconds < self.slow_thresholds.get(message_type, self.slow_threshold):
+			return
+		self.slow_requests.append((time.time(), message_type, seconds, addr))
+		self.server.log('Slow request: type %d from %s:%d took %.3fs' %
+			(ord(message_type), addr[0], addr[1], seconds))
+
+	def category_objects(self):
+		'''
+		returns {category: objects} for the routing table contacts, pending
+		lists and store values, the categories memory is reported for
+		'''
+		objects = {'contacts': [], 'pending': [], 'values': []}
+		with self.server.node.lock:
+			for b in self.server.node.buckets:
+				for c in b.contacts:
+					objects['contacts'].extend(contact_objects(c))
+				for c, _ in b.pending_removal:
+					objects['pending'].extend(contact_objects(c))
+				for c in b.pending_addition:
+					objects['pending'].extend(contact_objects(c))
+				objects['pending'].extend([b.pending_removal, b.pending_addition])
+		for v in list(self.server.store.store.values()):
+			objects['values'].extend([v, v.value])
+		return objects
+
+	def memory_usage(self):
+		'''
+		returns approximate bytes used by each category. Sizes come from
+		sys.getsizeof, not tracemalloc, so they are available even when
+		tracing is off, but miss allocator overhead
+		'''
+		usage = {}
+		for category, objects in self.category_objects().items():
+			usage[category] = sum(sys.getsizeof(o) +
+				(sys.getsizeof(o.__dict__) if hasattr(o, '__dict__') else 0) for o in objects)
+		return usage
+
+	def traced_usage(self, snapshot):
+		'''
+		Attributes traced memory in snapshot to each category by allocation
+		site: tracemalloc.get_object_traceback finds where the category's
+		objects were allocated and traces from those sites are summed. A site
+		that also allocated other live objects is charged in full. Objects
+		without a known site (allocated before tracing started, or instances
+		with a managed __dict__ before Python 3.12) are only counted.
+		Returns {category: (traced bytes, allocation sites, untraced objects)}
+		'''
+		sizes = collections.Counter()
+		for trace in snapshot.traces:
+			sizes[trace.traceback] += trace.size
+		usage = {}
+		for category, objects in self.category_objects().items():
+			sites = set()
+			untraced = 0
+			for o in objects:
+				traceback = tracemalloc.get_object_traceback(o)
+				if traceback is None:
+					untraced += 1
+				else:
+					sites.add(traceback)
+			usage[category] = (sum(sizes[s] for s in sites), len(sites), untraced)
+		return usage
+
+	def start_tracing(self, frames=1):
+		'''
+		starts tracemalloc. It slows down every allocation, so stop it with
+		stop_tracing once done
+		'''
+		if not tracemalloc.is_tracing():
+			tracemalloc.start(frames)
+			self.server.log('Started tracing memory allocations')
+
+	def stop_tracing(self):
+		if tracemalloc.is_tracing():
+			tracemalloc.stop()
+			self.server.log('Stopped tracing memory allocations')
+
+	def memory_snapshot(self, path=None, top=20):
+		'''
+		Writes a report to path with the approximate memory used by contacts,
+		pending lists and store values (see memory_usage). If tracemalloc was
+		started with start_tracing, the report also has the traced memory of
+		each category (see traced_usage) and the top allocation sites since
+		then, and the raw snapshot is dumped to path.snapshot for offline
+		analysis. Tracing is never started here, since allocation sites from
+		the last few milliseconds would tell nothing.
+		'''
+		path = path if path else self.snapshot_path
+		lines = ['Approximate sizes (sys.getsizeof):']
+		lines.extend('%s: %d bytes' % kv for kv in sorted(self.memory_usage().items()))
+		if tracemalloc.is_tracing():
+			snapshot = tracemalloc.take_snapshot()
+			snapshot.dump(path + '.snapshot')
+			lines.append('Traced memory by allocation site:')
+			for category, usage in sorted(self.traced_usage(snapshot).items()):
+				lines.append('%s: %d bytes from %d sites, %d objects without known site' %
+					((category, ) + usage))
+			lines.append('Top allocation sites since tracing started:')
+			lines.extend(str(s) for s in snapshot.statistics('lineno')[:top])
+		else:
+			lines.append('Allocation sites unavailable: tracemalloc is not running')
+		with open(path, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		self.server.log('Wrote memory report to %s' % path)
+		return path
+
+	def install_signals(self):
+		'''
+		SIGUSR1 profiles the request loop, SIGUSR2 writes a memory report.
+		Must be called from the main thread. Signals are also written to a
+		socket pair the request loop waits on, since otherwise an idle loop
+		blocked in recvfrom would not notice a profile request. Allocation
+		tracing is turned on and off with ADMIN messages
+		'''
+		self.wakeup, self.wakeup_writer = socket.socketpair()
+		self.wakeup.setblocking(False)
+		self.wakeup_writer.setblocking(False)
+		signal.set_wakeup_fd(self.wakeup_writer.fileno(), warn_on_full_buffer=False)
+		signal.signal(signal.SIGUSR1, lambda signum, frame: self.request_profile())
+		signal.signal(signal.SIGUSR2, lambda signum, frame: self.memory_snapshot())
+
+def contact_objects(c):
+	return [c, c.node_id, c.ip]
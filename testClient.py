@@ -0,0 +1,310 @@
+import unittest, threading, zlib
+from Client import *
+from Node import Contact, Node, segment_hashes, xor
+
+def start_server():
+	'''
+	runs a quiet Server on an ephemeral port in the background
+	'''
+	s = Server(Node(), verbose=False)
+	threading.Thread(target=s.handle_udp, args=(0,), daemon=True).start()
+	while s.udp_sock is None or s.udp_sock.getsockname()[1] == 0:
+		time.sleep(0.01)
+	s.client.initial_rto = 0.1
+	return s, ('127.0.0.1', s.udp_sock.getsockname()[1])
+
+class FakePeer(object):
+	'''
+	Answers requests with PONG echoing the request payload. Drops the first
+	`drop` requests and answers in reverse order once `batch` have arrived
+	'''
+	def __init__(self, drop=0, batch=1):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(('127.0.0.1', 0))
+		self.addr = self.sock.getsockname()
+		self.drop = drop
+		self.batch = batch
+		self.received = 0
+		threading.Thread(target=self.serve, daemon=True).start()
+
+	def serve(self):
+		waiting = []
+		while True:
+			try:
+				data, addr = self.sock.recvfrom(1000)
+			except OSError:
+				return
+			self.received += 1
+			if self.drop > 0:
+				self.drop -= 1
+				continue
+			waiting.append((data, addr))
+			if len(waiting) >= self.batch:
+				for data, addr in reversed(waiting):
+					self.sock.sendto(Server.PONG + b'\x05'*32 + data[33:], addr)
+				waiting = []
+
+	def close(self):
+		self.sock.close()
+
+class TestRttEstimator(unittest.TestCase):
+	def test_sample(self):
+		r = RttEstimator(1.0, min_rto=0.01)
+		self.assertEqual(r.timeout(), 1.0)
+		r.sample(0.1)
+		self.assertAlmostEqual(r.srtt, 0.1)
+		self.assertAlmostEqual(r.rto, 0.3)
+		for _ in range(50):
+			r.sample(0.1)
+		self.assertAlmostEqual(r.srtt, 0.1)
+		self.assertTrue(r.rto < 0.11)
+
+	def test_timeout(self):
+		r = RttEstimator(1.0, max_rto=5.0)
+		self.assertEqual(r.timeout(1), 2.0)
+		self.assertEqual(r.timeout(2), 4.0)
+		self.assertEqual(r.timeout(10), 5.0)
+		r.sample(100)
+		self.assertEqual(r.timeout(), 5.0)
+
+class TestClient(unittest.TestCase):
+	def setUp(self):
+		self.client = Client(b'\x01'*32, initial_rto=0.1)
+
+	def tearDown(self):
+		self.client.close()
+
+	def test_multiplexing(self):
+		peer = FakePeer(batch=10)
+		futures = [self.client.ping(peer.addr) for _ in range(5)]
+		futures.extend(self.client.find_node(peer.addr, bytes([i])*32) for i in range(5))
+		for f in futures[:5]:
+			self.assertEqual(f.result(1), (Server.PONG, b'\x05'*32, b''))
+		for i, f in enumerate(futures[5:]):
+			#replies arrive in reverse order but still match their request
+			self.assertEqual(f.result(1)[2], bytes([i])*32)
+		self.assertEqual(self.client.pending, {})
+		peer.close()
+
+	def test_many_peers(self):
+		peers = [FakePeer() for _ in range(4)]
+		futures = [(p, self.client.find_node(p.addr, p.addr[1].to_bytes(32, 'big'))) for p in peers]
+		for p, f in futures:
+			self.assertEqual(f.result(1)[2], p.addr[1].to_bytes(32, 'big'))
+		for p in peers:
+			p.close()
+
+	def test_retry(self):
+		peer = FakePeer(drop=2)
+		f = self.client.store(peer.addr, b'\x02'*32, b'value')
+		self.assertEqual(f.result(2)[2], b'\x02'*32 + b'value')
+		self.assertEqual(peer.received, 3)
+		#retransmitted requests do not produce rtt samples
+		self.assertIsNone(self.client.rtt(peer.addr).srtt)
+		self.assertIsNotNone(self.client.ping(peer.addr).result(1))
+		self.assertIsNotNone(self.client.rtt(peer.addr).srtt)
+		peer.close()
+
+	def test_timeout(self):
+		peer = FakePeer(drop=100)
+		self.client.retries = 2
+		f = self.client.ping(peer.addr)
+		self.assertRaises(RpcTimeout, f.result, 2)
+		self.assertEqual(peer.received, 3)
+		self.assertEqual(self.client.pending, {})
+		peer.close()
+
+	def test_rtt_eviction(self):
+		self.client.max_peers = 2
+		peers = [FakePeer() for _ in range(3)]
+		for p in peers[:2]:
+			self.client.ping(p.addr).result(1)
+		#using a peer makes it most recently used
+		self.client.ping(peers[0].addr).result(1)
+		self.client.ping(peers[2].addr).result(1)
+		self.assertEqual(list(self.client.rtts), [peers[0].addr, peers[2].addr])
+		self.assertIsNotNone(self.client.rtts[peers[0].addr].srtt)
+		for p in peers:
+			p.close()
+
+	def test_send_error(self):
+		#sending to port 0 fails immediately
+		self.assertRaises(OSError, self.client.ping, ('127.0.0.1', 0))
+		self.assertEqual(self.client.pending, {})
+		#failed send must not stop retransmissions
+		peer = FakePeer(drop=100)
+		self.client.retries = 1
+		self.assertRaises(RpcTimeout, self.client.ping(peer.addr).result, 2)
+
+		#retransmission that fails fails the request
+		class FailingSocket(object):
+			def sendto(self, data, addr):
+				raise OSError('network is unreachable')
+		sock = self.client.udp_sock
+		f = self.client.ping(peer.addr)
+		self.client.udp_sock = FailingSocket()
+		self.assertRaisesRegex(OSError, 'unreachable', f.result, 2)
+		self.client.udp_sock = sock
+		self.assertEqual(self.client.pending, {})
+		self.assertRaises(RpcTimeout, self.client.ping(peer.addr).result, 2)
+		peer.close()
+
+class TestFetchLargeValue(unittest.TestCase):
+	def setUp(self):
+		self.client = Client(b'\x01'*32, initial_rto=0.1, retries=1)
+		self.key = b'\x02'*32
+		self.value = os.urandom(50*SEGMENT_SIZE + 123)
+
+	def tearDown(self):
+		self.client.close()
+
+	def find_value(self, addr):
+		code, _, info = self.client.find_value(addr, self.key).result(1)
+		self.assertEqual(code, Server.LARGE_VALUE_FOUND)
+		return info
+
+	def test_fetch(self):
+		servers = [start_server() for _ in range(3)]
+		for s, _ in servers:
+			s.store[self.key] = self.value
+		addrs = [addr for _, addr in servers]
+		info = self.find_value(addrs[0])
+		self.assertEqual(self.client.fetch_large_value(addrs, self.key, info, 4), self.value)
+		self.assertEqual(self.client.fetch_large_value(addrs[:1], self.key, info), self.value)
+
+	def test_corrupt_replica(self):
+		good, good_addr = start_server()
+		bad, bad_addr = start_server()
+		good.store[self.key] = self.value
+		#bad replica advertises the right manifest but serves wrong segments
+		bad.store[self.key] = os.urandom(len(self.value))
+		bad.manifests[(self.key, False)] = segment_hashes(self.value)
+		info = self.find_value(good_addr)
+		value = self.client.fetch_large_value([bad_addr, good_addr], self.key, info)
+		self.assertEqual(value, self.value)
+		self.assertRaises(RpcTimeout, self.client.fetch_large_value, [bad_addr], self.key, info)
+
+	def test_wrong_manifest(self):
+		s, addr = start_server()
+		s.store[self.key] = self.value
+		info = self.find_value(addr)
+		s.manifests[(self.key, False)] = segment_hashes(os.urandom(len(self.value)))
+		self.assertRaises(ValueError, self.client.fetch_large_value, [addr], self.key, info)
+		self.assertRaises(ValueError, self.client.fetch_large_value, [addr], self.key, b'short')
+
+	def test_get_value(self):
+		servers = [start_server() for _ in range(2)]
+		addrs = [addr for _, addr in servers]
+		#compresses to fit in one datagram, compressed large value, incompressible
+		small = b'{"key": "value"}'*100
+		large = b''.join(b'{"id": %d}' % i for i in range(5000))
+		for value in [small, large, self.value]:
+			for s, _ in servers:
+				s.store[self.key] = value
+				s.manifests = {}
+			self.assertEqual(self.client.get_value(addrs, self.key), value)
+		self.assertEqual(self.client.find_value(addrs[0], self.key, False).result(1)[0],
+			Server.LARGE_VALUE_FOUND)
+		self.assertEqual(self.client.get_value(addrs, b'\x03'*32), None)
+
+	def test_decompress(self):
+		self.client.max_value_size = 1000
+		self.assertEqual(self.client.decompress(zlib.compress(b'a'*1000)), b'a'*1000)
+		self.assertRaises(ValueError, self.client.decompress, zlib.compress(b'a'*1001))
+		self.assertRaises(ValueError, self.client.decompress, zlib.compress(b'a'*100)[:-4])
+		self.assertRaises(ValueError, self.client.decompress, b'garbage')
+		s, addr = start_server()
+		s.store[self.key] = b'\x00'*10000
+		self.assertRaises(ValueError, self.client.get_value, [addr], self.key)
+		s.store[self.key] = self.value
+		self.assertRaises(ValueError, self.client.get_value, [addr], self.key)
+
+class TestBootstrap(unittest.TestCase):
+	def test_bootstrap(self):
+		seed, seed_addr = start_server()
+		servers = []
+		for i in range(12):
+			s, addr = start_server()
+			#dead seeds are ignored
+			seeds = [seed_addr, ('127.0.0.1', 1)] if i == 0 else [seed_addr]
+			self.assertTrue(s.bootstrap(seeds))
+			servers.append((s, addr))
+		#new node learns about the whole network from a single seed
+		s, addr = start_server()
+		self.assertTrue(s.bootstrap([seed_addr]))
+		known = [c.node_id for b in s.node.buckets for c in b.contacts]
+		self.assertEqual(len(known), 13)
+		self.assertEqual(set(known), set(x.node.node_id for x, _ in servers + [(seed, seed_addr)]))
+		#lookup finds nodes closest to target
+		target = os.urandom(32)
+		everyone = [x.node.node_id for x, _ in servers + [(seed, seed_addr)]]
+		everyone.sort(key=lambda i: xor(i, target))
+		self.assertEqual([c.node_id for c in s.lookup(target, 5)], everyone[:5])
+		#refreshed buckets count as active
+		self.assertEqual(s.node.stale_buckets(60), [])
+
+	def test_bootstrap_hostname(self):
+		seed, seed_addr = start_server()
+		s, _ = start_server()
+		self.assertTrue(s.bootstrap([('localhost', seed_addr[1])]))
+		contacts = [c for b in s.node.buckets for c in b.contacts]
+		self.assertEqual([c.ip for c in contacts], ['127.0.0.1'])
+		self.assertEqual(Contact.decode(contacts[0].encode()).node_id, seed.node.node_id)
+
+	def test_lookup_unreachable(self):
+		seed, seed_addr = start_server()
+		s, _ = start_server()
+		self.assertTrue(s.bootstrap([seed_addr]))
+		#sending to port 0 fails => contact is dropped from lookup
+		bad = Contact(os.urandom(32), '127.0.0.1', 0)
+		s.node.update_route(bad)
+		closest = s.lookup(bad.node_id)
+		self.assertEqual([c.node_id for c in closest], [seed.node.node_id])
+		self.assertTrue(s.bootstrap([('127.0.0.1', 0), seed_addr]))
+
+	def test_refresh_loop_survives_errors(self):
+		s, _ = start_server()
+		s.node.update_route(Contact(os.urandom(32), '127.0.0.1', 1))
+		calls = []
+		def refresh_bucket(j):
+			calls.append(j)
+			raise OSError('refresh failed')
+		s.refresh_bucket = refresh_bucket
+		logged = []
+		s.log = logged.append
+		s.start_refresh(0, 0.01)
+		time.sleep(0.2)
+		s.refresh_bucket = lambda j: None
+		self.assertTrue(len(calls) > 1)
+		self.assertIn("Bucket refresh failed: OSError('refresh failed')", logged)
+
+	def test_bootstrap_refreshes_concurrently(self):
+		seed, seed_addr = start_server()
+		s, _ = start_server()
+		s.client.retries = 0
+		#contact in bucket 240 => buckets 240 to 255 need a refresh
+		s.node.update_route(Contact(s.node.random_id_in_bucket(240), '127.0.0.1', 1))
+		running = []
+		peak = []
+		lock = threading.Lock()
+		def refresh_bucket(j):
+			with lock:
+				running.append(j)
+				peak.append(len(running))
+			time.sleep(0.05)
+			with lock:
+				running.remove(j)
+			if j % 2:
+				raise OSError('refresh failed')
+		s.refresh_bucket = refresh_bucket
+		self.assertTrue(s.bootstrap([seed_addr], parallel=4))
+		self.assertEqual(len(peak), 16)
+		self.assertEqual(max(peak), 4)
+
+	def test_no_seeds(self):
+		s, _ = start_server()
+		s.client.retries = 0
+		self.assertFalse(s.bootstrap([('127.0.0.1', 1)]))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -54,6 +54,26 @@ class TestKeyValueStore(unittest.TestCase):
 		self.assertFalse('d' in s)
 		self.assertTrue('e' in s)
 
+	def test_compress(self):
+		s = KeyValueStore(compress=True)
+		big = b'{"name": "value"}'*100
+		s['a'] = big
+		s['b'] = b'x'
+		s['c'] = 3
+		self.assertEqual(s['a'], big)
+		self.assertEqual(s['b'], b'x')
+		self.assertEqual(s['c'], 3)
+		self.assertTrue(s.get_stored('a').compressed)
+		self.assertEqual(zlib.decompress(s.get_stored('a').value), big)
+		self.assertTrue(len(s.get_stored('a').value) < len(big))
+		#incompressible values are kept as is
+		self.assertFalse(s.get_stored('b').compressed)
+		self.assertEqual(s.get_stored('b').value, b'x')
+
+		s = KeyValueStore()
+		s['a'] = big
+		self.assertFalse(s.get_stored('a').compressed)
+		self.assertEqual(s['a'], big)
 
 if __name__ == '__main__':
 	unittest.main()
@@ -1,4 +1,4 @@
-import unittest
+import unittest, unittest.mock, os, signal, threading, pstats, tempfile, tracemalloc, zlib
 from Node import *
 
 class TestHelpers(unittest.TestCase):
@@ -28,6 +28,13 @@ class TestHelpers(unittest.TestCase):
 		self.assertFalse(port_str_valid('65536'))
 		self.assertFalse(port_str_valid('-2134'))
 
+	def test_parse_addr(self):
+		self.assertEqual(parse_addr('127.0.0.1:8888'), ('127.0.0.1', 8888))
+		self.assertEqual(parse_addr('localhost:1'), ('localhost', 1))
+		self.assertIsNone(parse_addr('127.0.0.1'))
+		self.assertIsNone(parse_addr(':8888'))
+		self.assertIsNone(parse_addr('127.0.0.1:0'))
+
 	def test_insort_right(self):
 		a = [('a',1), ('b',2), ('d', 4)]
 		insort_right(a, ('c',3), lambda x,y: x[0] < y[0])
@@ -36,6 +43,18 @@ class TestHelpers(unittest.TestCase):
 		insort_right(a, ('z',0), lambda x,y: x[1] < y[1])
 		self.assertEqual(a, [('z', 0), ('a',1), ('b',2), ('c', 3), ('d', 4)])
 
+	def test_split_segments(self):
+		self.assertEqual(split_segments(b'abcdefg', 3), [b'abc', b'def', b'g'])
+		self.assertEqual(split_segments(b'abcdef', 3), [b'abc', b'def'])
+		self.assertEqual(split_segments(b'', 3), [])
+
+	def test_segment_hashes(self):
+		hs = segment_hashes(b'a'*1000)
+		self.assertEqual(len(hs), 3)
+		self.assertEqual(hs[0], hashlib.sha256(b'a'*SEGMENT_SIZE).digest())
+		self.assertEqual(hs[2], hashlib.sha256(b'a'*(1000 - 2*SEGMENT_SIZE)).digest())
+		self.assertEqual(manifest_root(hs), hashlib.sha256(b''.join(hs)).digest())
+
 class TestContact(unittest.TestCase):
 	def test_eq(self):
 		c1 = Contact(b'\x01'*32, '123.21.12.231', 1234)
@@ -78,6 +97,11 @@ class TestContact(unittest.TestCase):
 		self.assertEqual(c2p.ip, c2.ip)
 		self.assertEqual(c2p.port, c2.port)
 
+	def test_decode_invalid(self):
+		for ip, port in [('123.21.12.231', 0), ('0.0.0.0', 1234), ('255.255.255.255', 1234),
+				('224.0.0.1', 1234)]:
+			self.assertIsNone(Contact.decode(Contact(b'\x01'*32, ip, port).encode()))
+
 	def test_repr(self):
 		c1 = Contact(b'\x01'*32, '123.21.12.231', 1234)
 		self.assertEqual(c1.__repr__(), 'Contact(addr=123.21.12.231:1234, id=' + '01'*32 + ')')
@@ -230,11 +254,74 @@ class TestBucket(unittest.TestCase):
 		self.assertEqual(b.pending_addition, [c7])
 		self.assertEqual(b.contacts, [c6, c4])
 
+	def test_version(self):
+		c1 = Contact(b'\x01'*32, '123.21.12.231', 1234)
+		c2 = Contact(b'\x02'*32, '123.21.12.231', 1234)
+		c3 = Contact(b'\x03'*32, '123.21.12.231', 1234)
+		b = Bucket(1)
+		b.update(c1)
+		self.assertEqual(b.version, 1)
+		#moving seen contact to tail keeps membership
+		b.update(c1)
+		self.assertEqual(b.version, 1)
+		#eviction to pending lists changes membership
+		b.update(c2, 0.1)
+		self.assertEqual(b.version, 2)
+		b.update(c2)
+		self.assertEqual(b.version, 2)
+		#full set of contacts pending addition => new contact is ignored
+		b.update(c3)
+		self.assertEqual(b.version, 2)
+		#contact pending removal is restored
+		b.update(c1)
+		self.assertEqual(b.version, 3)
+		#pending addition is promoted when removal expires
+		b.update(c2, 0.1)
+		time.sleep(0.2)
+		b.update(c2)
+		self.assertEqual((b.contacts, b.version), ([c2], 5))
+
 class TestNode(unittest.TestCase):
 	def test_update_route(self):
 		#just wrapper for bucket update
 		pass
 
+	def test_concurrent_update_route(self):
+		n = Node()
+		contacts = [Contact(n.random_id_in_bucket(255), '1.2.3.4', i + 1) for i in range(40)]
+		def update():
+			for _ in range(50):
+				for c in contacts:
+					n.update_route(Contact(c.node_id, c.ip, c.port), ttl=0)
+		threads = [threading.Thread(target=update) for _ in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		b = n.buckets[255]
+		ids = [c.node_id for c in b.contacts + b.pending_addition]
+		self.assertEqual(len(ids), len(set(ids)))
+		self.assertTrue(len(b.contacts) + len(b.pending_removal) <= b.max_size)
+
+	def test_random_id_in_bucket(self):
+		n = Node()
+		for j in [0, 1, 7, 100, 255]:
+			for _ in range(10):
+				self.assertEqual(bucket_index(n.distance(n.random_id_in_bucket(j))), j)
+
+	def test_stale_buckets(self):
+		n = Node()
+		self.assertEqual(n.stale_buckets(0), [])
+		c = Contact(n.random_id_in_bucket(250), '123.21.12.231', 1234)
+		n.update_route(c)
+		self.assertEqual(n.stale_buckets(0), list(range(250, 256)))
+		self.assertEqual(n.stale_buckets(10), [])
+		for j in [251, 253, 255]:
+			n.buckets[j].last_activity -= 20
+		self.assertEqual(n.stale_buckets(10), [251, 253, 255])
+		n.update_route(Contact(n.random_id_in_bucket(251), '123.21.12.231', 1234))
+		self.assertEqual(n.stale_buckets(10), [253, 255])
+
 	def test_closest_nodes(self):
 		c1 = Contact(b'\x01'*32, '123.21.12.231', 1234)
 		c2 = Contact(b'\x02'*32, '123.21.12.231', 1234)
@@ -249,5 +336,288 @@ class TestNode(unittest.TestCase):
 		self.assertEqual(n.closest_nodes(b'\x02'*32, 1), [c2])
 		self.assertEqual(n.closest_nodes(b'\x08'*32, 3), [c1, c2, c3])
 
+	def brute_force_closest(self, n, target, k):
+		contacts = [c for b in n.buckets for c in b.contacts + b.pending_addition]
+		return sorted(contacts, key=lambda c: xor(c.node_id, target))[:k]
+
+	def test_closest_nodes_batch(self):
+		n = Node()
+		self.assertEqual(n.closest_nodes_batch([b'\x02'*32], 3), [[]])
+		for _ in range(300):
+			n.update_route(Contact(os.urandom(32), '123.21.12.231', 1234))
+		targets = [os.urandom(32) for _ in range(50)] + [n.node_id]
+		for k in [1, 20, 1000]:
+			batch = n.closest_nodes_batch(targets, k)
+			self.assertEqual(len(batch), len(targets))
+			for t, closest in zip(targets, batch):
+				self.assertEqual(closest, self.brute_force_closest(n, t, k))
+
+	@unittest.skipIf(numpy is None, 'numpy not installed')
+	def test_snapshot(self):
+		n = Node()
+		#ids that share their most significant 8 bytes tie on the first limb
+		for i in range(100):
+			n.update_route(Contact(b'\x80'*8 + os.urandom(24), '123.21.12.231', 1234))
+		for i in range(100):
+			n.update_route(Contact(os.urandom(32), '123.21.12.231', 1234))
+		targets = [b'\x80'*8 + os.urandom(24) for _ in range(10)] + [os.urandom(32) for _ in range(10)]
+		#small max_pairs to exercise chunking
+		n.snapshot.refresh()
+		for t, closest in zip(targets, n.snapshot.closest(targets, 7, max_pairs=500)):
+			self.assertEqual(closest, self.brute_force_closest(n, t, 7))
+		self.assertEqual(n.snapshot.closest(ids_to_limbs(targets), 7), n.snapshot.closest(targets, 7))
+		self.assertEqual(n.snapshot.closest([], 7), [])
+
+		#only changed buckets are repacked
+		cached = dict(n.snapshot.bucket_cache)
+		old_contacts, old_ids = n.snapshot.table
+		c = Contact(n.random_id_in_bucket(3), '123.21.12.231', 1234)
+		n.update_route(c)
+		n.snapshot.refresh()
+		for j, entry in n.snapshot.bucket_cache.items():
+			if j == 3:
+				self.assertEqual(entry[1], [c])
+			else:
+				self.assertIs(entry, cached[j])
+		#table is replaced as a whole, so old one stays consistent
+		contacts, ids = n.snapshot.table
+		self.assertEqual((len(contacts), len(ids)), (len(old_contacts) + 1, len(old_ids) + 1))
+		self.assertEqual(len(old_contacts), len(old_ids))
+		self.assertEqual(n.closest_nodes_batch([c.node_id], 1), [[c]])
+		#seeing known contacts again does not repack anything
+		table = n.snapshot.table
+		n.update_route(c)
+		n.snapshot.refresh()
+		self.assertIs(n.snapshot.table, table)
+
+class FakeSocket(object):
+	def __init__(self):
+		self.sent = []
+
+	def sendto(self, data, addr):
+		self.sent.append((data, addr))
+
+class TestServer(unittest.TestCase):
+	def setUp(self):
+		self.server = Server(Node(), verbose=False)
+		self.server.udp_sock = FakeSocket()
+		self.server.client_addr = ('127.0.0.1', 1234)
+
+	def request(self, code, message):
+		self.server.packet_data = code + b'\x01'*32 + b'\xaa'*16 + message
+		self.server.parse_header()
+		{
+			Server.FIND_VALUE: self.server.handle_find_value,
+			Server.FETCH_MANIFEST: self.server.handle_fetch_manifest,
+			Server.FETCH_SEGMENT: self.server.handle_fetch_segment,
+			Server.FIND_NODE: self.server.handle_find_node,
+			Server.STORE: self.server.handle_store,
+		}[code]()
+		data = self.server.udp_sock.sent.pop()[0]
+		self.assertEqual(data[33:49], b'\xaa'*16)
+		return data[0:1], data[49:]
+
+	def test_find_large_value(self):
+		key = b'\x02'*32
+		value = os.urandom(20*SEGMENT_SIZE + 10)
+		self.server.store[key] = value
+		hs = segment_hashes(value)
+		self.assertEqual(self.request(Server.FIND_VALUE, key),
+			(Server.LARGE_VALUE_FOUND, struct.pack('!I', len(value)) + manifest_root(hs) + b'\x00'))
+
+		self.assertEqual(self.request(Server.FETCH_MANIFEST, key + b'\x00\x00\x00\x00'),
+			(Server.MANIFEST_PAGE, b'\x00\x00\x00\x00' + b''.join(hs[:MANIFEST_PAGE_SIZE])))
+		self.assertEqual(self.request(Server.FETCH_MANIFEST, key + b'\x00\x00\x00\x01'),
+			(Server.MANIFEST_PAGE, b'\x00\x00\x00\x01' + b''.join(hs[MANIFEST_PAGE_SIZE:])))
+		self.assertEqual(self.request(Server.FETCH_MANIFEST, key + b'\x00\x00\x00\x02')[0],
+			Server.ERROR)
+
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, key + b'\x00\x00\x00\x01'),
+			(Server.SEGMENT, b'\x00\x00\x00\x01' + value[SEGMENT_SIZE:2*SEGMENT_SIZE]))
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, key + b'\x00\x00\x00\x14'),
+			(Server.SEGMENT, b'\x00\x00\x00\x14' + value[-10:]))
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, key + b'\x00\x00\x00\x15')[0],
+			Server.ERROR)
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, b'\x03'*32 + b'\x00\x00\x00\x00')[0],
+			Server.ERROR)
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, key)[0], Server.ERROR)
+
+		#storing new value invalidates manifest
+		self.assertEqual(self.request(Server.STORE, key + b'small')[0], Server.STORE_SUCCESS)
+		self.assertEqual(self.request(Server.FIND_VALUE, key), (Server.SMALL_VALUE_FOUND, b'small'))
+		self.assertFalse((key, False) in self.server.manifests)
+
+	def test_find_compressed_value(self):
+		key = b'\x02'*32
+		value = b'{"key": "value"}'*100
+		self.assertEqual(self.request(Server.STORE, key + value)[0], Server.STORE_SUCCESS)
+		compressed = self.server.store.get_stored(key).value
+		self.assertEqual(zlib.decompress(compressed), value)
+		self.assertEqual(self.request(Server.FIND_VALUE, key + b'\x01'),
+			(Server.COMPRESSED_VALUE_FOUND, compressed))
+		#clients that don't accept compressed values fetch the original
+		hs = segment_hashes(value)
+		self.assertEqual(self.request(Server.FIND_VALUE, key + b'\x00'),
+			(Server.LARGE_VALUE_FOUND, struct.pack('!I', len(value)) + manifest_root(hs) + b'\x00'))
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, key + b'\x00\x00\x00\x01'),
+			(Server.SEGMENT, b'\x00\x00\x00\x01' + value[SEGMENT_SIZE:2*SEGMENT_SIZE]))
+
+		#large compressed values are served in compressed segments
+		value = b''.join(b'{"id": %d}' % i for i in range(5000))
+		self.request(Server.STORE, key + value)
+		compressed = self.server.store.get_stored(key).value
+		self.assertTrue(512 < len(compressed) < len(value))
+		hs = segment_hashes(compressed)
+		self.assertEqual(self.request(Server.FIND_VALUE, key + b'\x01'),
+			(Server.LARGE_VALUE_FOUND, struct.pack('!I', len(compressed)) + manifest_root(hs) + b'\x01'))
+		self.assertEqual(self.request(Server.FETCH_SEGMENT, key + b'\x00\x00\x00\x00\x01'),
+			(Server.SEGMENT, b'\x00\x00\x00\x00' + compressed[:SEGMENT_SIZE]))
+		self.assertEqual(self.request(Server.FETCH_MANIFEST, key + b'\x00\x00\x00\x00\x01'),
+			(Server.MANIFEST_PAGE, b'\x00\x00\x00\x00' + b''.join(hs[:MANIFEST_PAGE_SIZE])))
+
+		#decompressed value is cached for segment fetches
+		with unittest.mock.patch('zlib.decompress', wraps=zlib.decompress) as decompress:
+			self.request(Server.FIND_VALUE, key)
+			for i in range(len(value)//SEGMENT_SIZE):
+				self.request(Server.FETCH_SEGMENT, key + struct.pack('!I', i))
+			self.request(Server.FETCH_MANIFEST, key + b'\x00\x00\x00\x00')
+			self.assertEqual(decompress.call_count, 1)
+			self.request(Server.STORE, key + value)
+			self.request(Server.FETCH_SEGMENT, key + b'\x00\x00\x00\x00')
+			self.assertEqual(decompress.call_count, 2)
+
+		#unknown key with flags falls back to find node
+		self.assertEqual(self.request(Server.FIND_VALUE, b'\x03'*32 + b'\x01'),
+			(Server.FIND_NODE_REPLY, b''))
+
+class TestProfiler(unittest.TestCase):
+	def setUp(self):
+		self.server = Server(Node(), verbose=False)
+		self.server.udp_sock = FakeSocket()
+		self.dir = tempfile.TemporaryDirectory()
+		self.profiler = self.server.profiler
+		self.profiler.profile_path = os.path.join(self.dir.name, 'node.prof')
+		self.profiler.snapshot_path = os.path.join(self.dir.name, 'node.mem')
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def admin(self, message, addr=('127.0.0.1', 1234)):
+		self.server.client_addr = addr
+		self.server.packet_data = Server.ADMIN + b'\x01'*32 + b'\xaa'*16 + message
+		self.server.parse_header()
+		self.server.handle_admin()
+		data = self.server.udp_sock.sent.pop()[0]
+		return data[0:1], data[49:]
+
+	def test_profile(self):
+		self.assertEqual(self.admin(b'\x01\x00\x00\x00\x01'),
+			(Server.ADMIN_REPLY, self.profiler.profile_path.encode()))
+		self.profiler.poll()
+		self.assertIsNotNone(self.profiler.profile)
+		self.server.node.closest_nodes(b'\x02'*32)
+		time.sleep(1)
+		self.profiler.poll()
+		self.assertIsNone(self.profiler.profile)
+		stats = pstats.Stats(self.profiler.profile_path)
+		self.assertTrue(any(f[2] == 'closest_nodes' for f in stats.stats))
+
+	def test_profile_without_traffic(self):
+		self.server = Server(Node(), verbose=False)
+		self.server.profiler.profile_path = self.profiler.profile_path
+		threading.Thread(target=self.server.handle_udp, args=(0,), daemon=True).start()
+		while self.server.udp_sock is None:
+			time.sleep(0.01)
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.settimeout(1)
+		addr = ('127.0.0.1', self.server.udp_sock.getsockname()[1])
+		sock.sendto(Server.ADMIN + b'\x01'*32 + b'\xaa'*16 + b'\x01\x00\x00\x00\x01', addr)
+		self.assertEqual(sock.recvfrom(1000)[0][49:], self.profiler.profile_path.encode())
+		sock.close()
+		#profile is written once time is up, no further request needed
+		time.sleep(1.5)
+		self.assertIsNone(self.server.profiler.profile)
+		self.assertTrue(os.path.exists(self.profiler.profile_path))
+
+	def test_profile_signal(self):
+		self.server = Server(Node(), verbose=False)
+		profiler = self.server.profiler
+		profiler.profile_path = self.profiler.profile_path
+		profiler.snapshot_path = self.profiler.snapshot_path
+		profiler.profile_seconds = 0.2
+		handlers = [signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)]
+		profiler.install_signals()
+		try:
+			threading.Thread(target=self.server.handle_udp, args=(0,), daemon=True).start()
+			while self.server.udp_sock is None:
+				time.sleep(0.01)
+			time.sleep(0.1)
+			#idle request loop wakes up to start and stop profile
+			os.kill(os.getpid(), signal.SIGUSR1)
+			time.sleep(1)
+			self.assertIsNone(profiler.profile)
+			self.assertTrue(os.path.exists(profiler.profile_path))
+		finally:
+			signal.set_wakeup_fd(-1)
+			signal.signal(signal.SIGUSR1, handlers[0])
+			signal.signal(signal.SIGUSR2, handlers[1])
+
+	def test_memory_snapshot(self):
+		for i in range(10):
+			self.server.node.update_route(Contact(self.server.node.random_id_in_bucket(255), '1.2.3.4', 1))
+		self.server.store[b'\x01'*32] = b'a'*1000
+		usage = self.profiler.memory_usage()
+		self.assertTrue(usage['contacts'] > 10*32)
+		self.assertTrue(usage['pending'] > 0)
+		self.assertTrue(usage['values'] > 0)
+		#without tracing, report only has approximate sizes
+		self.assertEqual(self.admin(b'\x02'), (Server.ADMIN_REPLY, self.profiler.snapshot_path.encode()))
+		self.assertFalse(tracemalloc.is_tracing())
+		with open(self.profiler.snapshot_path) as f:
+			report = f.read()
+		self.assertTrue('contacts: %d bytes' % usage['contacts'] in report)
+		self.assertTrue('tracemalloc is not running' in report)
+		self.assertFalse(os.path.exists(self.profiler.snapshot_path + '.snapshot'))
+
+		self.assertEqual(self.admin(b'\x03'), (Server.ADMIN_REPLY, b''))
+		self.assertTrue(tracemalloc.is_tracing())
+		try:
+			self.server.store[b'\x02'*32] = os.urandom(100000)
+			self.admin(b'\x02')
+			#only value stored after tracing started has an allocation site
+			traced, sites, untraced = self.profiler.traced_usage(tracemalloc.take_snapshot())['values']
+			self.assertTrue(traced >= 100000)
+			self.assertTrue(sites > 0)
+			self.assertTrue(untraced >= 2)
+		finally:
+			self.assertEqual(self.admin(b'\x04'), (Server.ADMIN_REPLY, b''))
+		self.assertFalse(tracemalloc.is_tracing())
+		with open(self.profiler.snapshot_path) as f:
+			report = f.read()
+		self.assertTrue('Traced memory by allocation site' in report)
+		self.assertTrue('contacts: 0 bytes from 0 sites, 30 objects without known site' in report)
+		self.assertTrue('Top allocation sites' in report)
+		self.assertTrue(os.path.exists(self.profiler.snapshot_path + '.snapshot'))
+
+	def test_admin_errors(self):
+		self.assertEqual(self.admin(b'\x02', ('10.0.0.1', 1234))[0], Server.ERROR)
+		self.assertEqual(self.admin(b'\x07')[0], Server.ERROR)
+		self.assertEqual(self.admin(b'\x03\x00')[0], Server.ERROR)
+		self.assertEqual(self.admin(b'\x01\x00')[0], Server.ERROR)
+
+	def test_slow_requests(self):
+		self.profiler.slow_thresholds = {Server.STORE: 0.5}
+		logged = []
+		self.server.log = logged.append
+		addr = ('127.0.0.1', 1234)
+		self.profiler.request_finished(Server.STORE, 0.2, addr)
+		self.profiler.request_finished(Server.PING, 0.01, addr)
+		self.assertEqual(len(self.profiler.slow_requests), 0)
+		self.profiler.request_finished(Server.PING, 0.2, addr)
+		self.profiler.request_finished(Server.STORE, 0.6, addr)
+		self.assertEqual([r[1:] for r in self.profiler.slow_requests],
+			[(Server.PING, 0.2, addr), (Server.STORE, 0.6, addr)])
+		self.assertEqual(logged[-1], 'Slow request: type 3 from 127.0.0.1:1234 took 0.600s')
+
 if __name__ == '__main__':
 	unittest.main()